@@ -7,24 +7,34 @@ Slackclone with Supabase + Streamlit
 - DMs + Group chats
 - Optimistic messaging (⏳/✅/⚠️)
 - 3-column layout: Left (friends & convos), Center (messages), Right (profile)
-- Scrollable message panel (HTML iframe)
+- Scrollable message panel (st.container; messages as one escaped HTML block, st.chat_message only for failed sends)
 - Avatars via Supabase Storage (bucket 'avatars')
 """
 
 import os
 import re
+import sys
 import uuid
-import random
 import time
+import queue
+import asyncio
+import threading
+import itertools
+import weakref
 import mimetypes
-import html as py_html
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 import streamlit as st
-from supabase import create_client
+from supabase import create_client, acreate_client
+from realtime import RealtimeSubscribeStates
 from postgrest import APIError
 from streamlit_supabase_auth import login_form, logout_button
 from streamlit.components.v1 import html
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # =========================
 # Config
@@ -73,7 +83,12 @@ refresh_token = session.get("refresh_token", "")
 
 logout_button(apiKey=SUPABASE_ANON_KEY)
 
-@st.cache_resource(show_spinner=False)
+# Process-wide caches keyed per user are sized for this many concurrent users
+MAX_ACTIVE_USERS = 256
+
+# No TTL: with auto-refresh the cached client is what keeps rotating the session, and a
+# rebuilt one would only have the original (expired) tokens. Bound the count instead.
+@st.cache_resource(show_spinner=False, max_entries=MAX_ACTIVE_USERS)
 def authed_client(access_token: str, refresh_token: str):
     cli = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
     cli.auth.set_session(access_token, refresh_token or "")
@@ -84,32 +99,34 @@ auth = authed_client(access_token, refresh_token)
 # =========================
 # Profile / unique username
 # =========================
+_RE_NON_ALNUM = re.compile(r"[^a-z0-9_]")
+_RE_UNDERSCORES = re.compile(r"_+")
+_RE_TAGS = re.compile(r"<[^>]+>")
+
 def _slugify(s: str, fallback: str) -> str:
     if not s: return fallback
     s = s.strip().lower().replace("-", "_")
-    s = re.sub(r"[^a-z0-9_]", "", s)
-    s = re.sub(r"_+", "_", s).strip("_")
+    s = _RE_NON_ALNUM.sub("", s)
+    s = _RE_UNDERSCORES.sub("_", s).strip("_")
     return s or fallback
 
+_ALPHABET = b"bcdfghjklmnpqrstvwxyz0123456789"
+
 def _rand_suffix(n=3) -> str:
-    alphabet = "bcdfghjklmnpqrstvwxyz0123456789"
-    return "".join(random.choice(alphabet) for _ in range(n))
+    # OS entropy mapped onto the alphabet; slight modulo bias is irrelevant for handles
+    return bytes(_ALPHABET[b % len(_ALPHABET)] for b in os.urandom(n)).decode()
 
-def _username_available(auth_cli, handle: str) -> bool:
-    res = auth_cli.table("profiles").select("id").eq("username", handle).limit(1).execute()
-    return not bool(res.data)
+def _taken_usernames(auth_cli, handles: list[str]) -> set:
+    res = auth_cli.table("profiles").select("username").in_("username", handles).execute()
+    return {r["username"] for r in res.data or []}
 
 def _next_available_username(auth_cli, base: str) -> str:
-    if _username_available(auth_cli, base): return base
-    for i in range(2, 20):
-        cand = f"{base}{i}"
-        if _username_available(auth_cli, cand): return cand
-    for _ in range(50):
-        cand = f"{base}{_rand_suffix(3)}"
-        if _username_available(auth_cli, cand): return cand
-    while True:
-        cand = f"{base}{_rand_suffix(6)}"
-        if _username_available(auth_cli, cand): return cand
+    # Check every candidate in one round trip, in preference order
+    cands = [base] + [f"{base}{i}" for i in range(2, 20)] + [f"{base}{_rand_suffix(3)}" for _ in range(50)]
+    taken = _taken_usernames(auth_cli, cands)
+    for cand in cands:
+        if cand not in taken: return cand
+    return f"{base}_{uuid.uuid4().hex[:8]}"
 
 def ensure_profile_with_username(auth_cli, me: str, user_meta: dict) -> dict:
     prof = auth_cli.table("profiles").select("id, username, full_name, avatar_url").eq("id", me).limit(1).execute().data
@@ -137,9 +154,36 @@ def ensure_profile_with_username(auth_cli, me: str, user_meta: dict) -> dict:
         prof["username"] = handle
     return prof
 
-profile = ensure_profile_with_username(auth, me, user.get("user_metadata", {}) or {})
+# The profile is stable for the session; bootstrap it once per signed-in user
+profile = st.session_state.get("profile")
+if not profile or profile["id"] != me:
+    profile = ensure_profile_with_username(auth, me, user.get("user_metadata", {}) or {})
+    st.session_state["profile"] = profile
 st.caption(f"Signed in as **@{profile['username']}**")
 
+# =========================
+# HTML escaping
+# =========================
+# Same output as html.escape(quote=True), done in one C-level pass
+_HTML_TRANS = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+def _esc(s: str) -> str:
+    return s.translate(_HTML_TRANS)
+
+# =========================
+# Display names
+# =========================
+@lru_cache(maxsize=2048)
+def short(id_: str) -> str:
+    """Short fallback label for an id (user or conversation) with nothing better to show."""
+    return id_[:8]
+
+def user_handle(prof: dict) -> str:
+    return prof.get("username") or short(prof["id"])
+
+def display_name(prof: dict) -> str:
+    return prof.get("full_name") or user_handle(prof)
+
 # =========================
 # Avatars (Storage helpers)
 # =========================
@@ -168,12 +212,37 @@ def upload_avatar_to_storage(auth_cli, user_id: str, file_bytes: bytes, mimetype
     # Public bucket: direct URL; for private, use create_signed_url instead.
     return auth_cli.storage.from_("avatars").get_public_url(path)
 
+# Image transforms are a paid Supabase feature; opt in via env/secrets.
+def _image_transforms_setting() -> str:
+    val = os.getenv("SUPABASE_IMAGE_TRANSFORMS")
+    if val is None:
+        try:
+            val = st.secrets.get("SUPABASE_IMAGE_TRANSFORMS", "")
+        except FileNotFoundError:  # env-only deployments have no secrets.toml
+            val = ""
+    return str(val)
+
+IMAGE_TRANSFORMS = _image_transforms_setting().lower() in ("1", "true", "yes")
+_STORAGE_OBJECT_PATH = "/storage/v1/object/public/"
+_STORAGE_RENDER_PATH = "/storage/v1/render/image/public/"
+
+def avatar_src(url: str | None, size: int = 28) -> str:
+    """Sized (2x for retina) variant of a Storage avatar URL when transforms are on."""
+    if not url or not IMAGE_TRANSFORMS or _STORAGE_OBJECT_PATH not in url:
+        return url or ""
+    px = size * 2
+    # Merge with any query the public URL already carries (some clients leave a bare "?")
+    parts = urlsplit(url.replace(_STORAGE_OBJECT_PATH, _STORAGE_RENDER_PATH, 1))
+    query = dict(parse_qsl(parts.query))
+    query.update(width=px, height=px, resize="cover")
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
 def avatar_img(url: str | None, size: int = 28) -> str:
     if not url:
         # simple placeholder circle
         return f"<div style='width:{size}px;height:{size}px;border-radius:50%;background:#ddd;display:inline-block;border:1px solid #eee;vertical-align:middle;'></div>"
     return (
-        f"<img src='{py_html.escape(url)}' width='{size}' height='{size}' "
+        f"<img src='{_esc(avatar_src(url, size))}' width='{size}' height='{size}' loading='lazy' decoding='async' "
         f"style='border-radius:50%;object-fit:cover;vertical-align:middle;border:1px solid #eee'/>"
     )
 
@@ -181,94 +250,303 @@ def avatar_img(url: str | None, size: int = 28) -> str:
 # Optimistic messaging
 # =========================
 if "optimistic" not in st.session_state:
-    # { conversation_id: [ {id,temp|db, sender_id, content, created_at, status} ] }
+    # { conversation_id: OrderedDict{ temp_id: {id, sender_id, content, created_at, status} } }
+    # temp_id is a uuid4 that is also sent as direct_messages.client_id (the insert's idempotency key)
     st.session_state["optimistic"] = {}
 
-def _optimistic_list(cid: str):
-    return st.session_state["optimistic"].setdefault(cid, [])
+def _optimistic(cid: str) -> OrderedDict:
+    return st.session_state["optimistic"].setdefault(cid, OrderedDict())
+
+def _touch_optimistic(cid: str):
+    """Bump the conversation's optimistic version; combined_messages re-merges only when it moves."""
+    versions = st.session_state.setdefault("opt_version", {})
+    versions[cid] = versions.get(cid, 0) + 1
+
+@lru_cache(maxsize=4096)
+def _parse_ts(s: str) -> datetime:
+    """Parse an ISO timestamp; memoized since the same server rows are re-parsed every rerun."""
+    if sys.version_info < (3, 11) and s.endswith("Z"):
+        s = s[:-1] + "+00:00"
+    return datetime.fromisoformat(s)
+
+@lru_cache(maxsize=4096)
+def _fmt_ts(s: str) -> str:
+    """Display form of an ISO timestamp; each distinct message time is formatted once per process."""
+    return _parse_ts(s).astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
 
 def _now_iso():
     return datetime.now(timezone.utc).isoformat()
 
 def add_optimistic_message(cid: str, sender_id: str, content: str):
     msg = {
-        "id": f"tmp-{uuid.uuid4()}",
+        "id": str(uuid.uuid4()),
         "sender_id": sender_id,
         "content": (content or "").strip(),
         "created_at": _now_iso(),
         "status": "sending",  # sending | sent | failed
     }
-    _optimistic_list(cid).append(msg)
+    _optimistic(cid)[msg["id"]] = msg
+    _touch_optimistic(cid)
     return msg
 
 def mark_optimistic(cid: str, temp_id: str, new_status: str):
-    for m in _optimistic_list(cid):
-        if m["id"] == temp_id:
-            m["status"] = new_status
-            return
+    m = _optimistic(cid).get(temp_id)
+    if m:
+        m["status"] = new_status
+        _touch_optimistic(cid)
+
+_BADGES = {"sending": "⏳ sending", "sent": "✅ sent", "failed": "⚠️ failed"}
+
+def retry_optimistic(cid: str, temp_id: str):
+    m = _optimistic(cid).get(temp_id)
+    if m:
+        m["status"] = "sending"
+        m["created_at"] = _now_iso()  # re-anchor the 10s delivery match to this attempt
+        _touch_optimistic(cid)
+        send_message_to_db(cid, m["content"], temp_id)
+
+def dismiss_optimistic(cid: str, temp_id: str):
+    if _optimistic(cid).pop(temp_id, None):
+        _touch_optimistic(cid)
 
 def drop_delivered_optimistic(cid: str, server_msgs: list):
     """Hide optimistic copies once an equivalent server message arrives (same sender+content within 10s)."""
-    lst = _optimistic_list(cid)
-    keep = []
-    for om in lst:
-        if om["status"] == "failed":
-            keep.append(om); continue
-        om_ts = datetime.fromisoformat(om["created_at"].replace("Z", "+00:00"))
-        matched = False
-        for sm in server_msgs:
-            if sm["sender_id"] != om["sender_id"]: continue
-            if (sm["content"] or "").strip() != (om["content"] or "").strip(): continue
-            sm_ts = datetime.fromisoformat(sm["created_at"].replace("Z", "+00:00"))
-            if abs((sm_ts - om_ts).total_seconds()) <= 10:
-                matched = True; break
-        if not matched:
-            keep.append(om)
-    st.session_state["optimistic"][cid] = keep
+    pending = st.session_state["optimistic"].get(cid)
+    if not pending: return
+    # (sender, content) -> server timestamps, so each optimistic message is one dict probe
+    idx = {}
+    for sm in server_msgs:
+        idx.setdefault((sm["sender_id"], (sm["content"] or "").strip()), []).append(_parse_ts(sm["created_at"]))
+    for om in list(pending.values()):
+        if om["status"] == "failed": continue
+        om_ts = _parse_ts(om["created_at"])
+        candidates = idx.get((om["sender_id"], (om["content"] or "").strip()), ())
+        if any(abs((t - om_ts).total_seconds()) <= 10 for t in candidates):
+            del pending[om["id"]]
+            _touch_optimistic(cid)
 
 def combined_messages(cid: str, server_msgs: list):
+    if not st.session_state["optimistic"].get(cid):
+        return server_msgs  # steady state: nothing pending, server order is already chronological
+    # Same server page and no optimistic change since last time: reuse the last merge
+    server_sig = (len(server_msgs), server_msgs[0]["id"], server_msgs[-1]["id"]) if server_msgs else ()
+    memo = st.session_state.setdefault("_merged", {})
+    key = (server_sig, st.session_state.get("opt_version", {}).get(cid, 0))
+    hit = memo.get(cid)
+    if hit and hit[0] == key:
+        return hit[1]
     drop_delivered_optimistic(cid, server_msgs)
-    merged = list(server_msgs) + list(_optimistic_list(cid))
-    def _ts(m): return datetime.fromisoformat(m["created_at"].replace("Z", "+00:00"))
-    return sorted(merged, key=_ts)
+    merged = list(server_msgs) + list(_optimistic(cid).values())
+    # Both sides are UTC "+00:00" ISO strings (load_messages normalizes "Z"), so they sort lexically
+    merged.sort(key=lambda m: m["created_at"])
+    # Re-read the version: dropping delivered copies above bumps it
+    memo[cid] = ((server_sig, st.session_state.get("opt_version", {}).get(cid, 0)), merged)
+    return merged
+
+# =========================
+# Write-behind outbox
+# =========================
+OUTBOX_BATCH_MAX = 20        # rows per insert
+OUTBOX_FLUSH_WINDOW = 0.05   # seconds to wait for a burst to fill a batch
+OUTBOX_MAX_ATTEMPTS = 3      # tries before a transport error surfaces as "failed"
+OUTBOX_IDLE_SECONDS = 300    # the writer thread exits after this long without sends
+
+class _Outbox:
+    """
+    Daemon writer that drains queued sends and inserts them in batches.
+    Results are published to a lock-guarded dict that the script thread
+    reads on the next rerun (worker threads must not touch session_state).
+    The thread is started by put() and exits when idle or closed.
+    """
+    def __init__(self, auth_cli, sender_id: str):
+        self.queue = queue.Queue()
+        self._cli = auth_cli
+        self._sender_id = sender_id
+        self._status = {}  # temp_id -> (conversation_id, "sent" | "failed")
+        self._attempts = {}  # temp_id -> transport failures so far (writer thread only)
+        self._lock = threading.Lock()
+        self._thread = None  # guarded by _thread_lock
+        self._thread_lock = threading.Lock()
+        self._closed = False
+
+    def serves(self, auth_cli, sender_id: str) -> bool:
+        return self._cli is auth_cli and self._sender_id == sender_id
+
+    def put(self, item: tuple):
+        self.queue.put(item)
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def close(self):
+        """Finish what is queued, then let the thread exit (None wakes it if it is waiting)."""
+        self._closed = True
+        self.queue.put(None)
+
+    def _retire(self) -> bool:
+        # Exit only if nothing was queued meanwhile; put() starts a new thread after this
+        with self._thread_lock:
+            if not self.queue.empty():
+                return False
+            self._thread = None
+            return True
+
+    def _next_batch(self) -> list:
+        """Up to OUTBOX_BATCH_MAX sends; empty when idle for OUTBOX_IDLE_SECONDS or woken by close()."""
+        try:
+            first = self.queue.get(timeout=OUTBOX_IDLE_SECONDS)
+        except queue.Empty:
+            return []
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + OUTBOX_FLUSH_WINDOW
+        while len(batch) < OUTBOX_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None: break
+            batch.append(item)
+        return batch
+
+    def _insert(self, batch: list) -> str:
+        """"sent", "rejected" (PostgREST refused the rows) or "error" (transport; worth retrying)."""
+        rows = [{"conversation_id": cid, "sender_id": self._sender_id, "content": text, "client_id": temp_id}
+                for cid, text, temp_id in batch]
+        try:
+            # A timeout can hide a committed insert; the unique client_id makes the retry a no-op then
+            self._cli.table("direct_messages").upsert(rows, on_conflict="client_id", ignore_duplicates=True).execute()
+            return "sent"
+        except APIError:
+            return "rejected"
+        except Exception:
+            return "error"
+
+    def _publish(self, batch: list, result: str):
+        with self._lock:
+            for cid, _, temp_id in batch:
+                self._status[temp_id] = (cid, result)
+
+    def _settle(self, item: tuple, result: str):
+        temp_id = item[2]
+        if result == "error":
+            attempts = self._attempts.get(temp_id, 0) + 1
+            if attempts < OUTBOX_MAX_ATTEMPTS:
+                # Back off 2s, 4s, ... on a timer thread so the writer keeps draining other sends
+                self._attempts[temp_id] = attempts
+                retry = threading.Timer(2 ** attempts, self.put, (item,))
+                retry.daemon = True
+                retry.start()
+                return
+        self._attempts.pop(temp_id, None)
+        self._publish([item], "sent" if result == "sent" else "failed")
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                result = self._insert(batch)
+                if result == "rejected" and len(batch) > 1:
+                    # One bad row (RLS, length check) fails the whole insert; retry rows individually
+                    for item in batch:
+                        self._settle(item, self._insert([item]))
+                else:
+                    for item in batch:
+                        self._settle(item, result)
+            if (self._closed or not batch) and self._retire():
+                return
+
+    def take_status(self) -> dict:
+        with self._lock:
+            done, self._status = self._status, {}
+        return done
+
+# One outbox per signed-in user and token: a new login (or a refreshed token) gets a
+# fresh writer, and the old one flushes what it already holds and exits
+_outbox = st.session_state.get("outbox")
+if _outbox is None or not _outbox.serves(auth, me):
+    if _outbox is not None:
+        _outbox.close()
+    st.session_state["outbox"] = _Outbox(auth, me)
+
+def apply_outbox_status():
+    """Reconcile sends the writer finished since the last (full or fragment) rerun."""
+    for temp_id, (cid, status) in st.session_state["outbox"].take_status().items():
+        mark_optimistic(cid, temp_id, status)
+
+apply_outbox_status()
 
 # =========================
 # Data helpers
 # =========================
-@st.cache_data(ttl=10)
-def search_users(query: str):
+# Cached helpers take the client as `_auth_cli`: the leading underscore tells
+# st.cache_data not to hash it, so keys are just the plain arguments.
+SEARCH_MIN_CHARS = 2
+SEARCH_LIMIT = 20
+SEARCH_TTL = 60
+
+def _ilike_contains(term: str) -> str:
+    """Quoted PostgREST ilike value matching `term` literally: LIKE wildcards escaped, then quoted."""
+    like = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return '"%' + like.replace("\\", "\\\\").replace('"', '\\"') + '%"'
+
+@st.cache_data(ttl=SEARCH_TTL, max_entries=128)
+def search_users(_auth_cli, me: str, query: str):
     if not query: return []
-    res = auth.table("profiles").select("id, username, full_name, avatar_url")\
-        .or_(f"username.ilike.%{query}%,full_name.ilike.%{query}%").neq("id", me).limit(20).execute()
+    pattern = _ilike_contains(query)
+    res = _auth_cli.table("profiles").select("id, username, full_name, avatar_url")\
+        .or_(f"username.ilike.{pattern},full_name.ilike.{pattern}").neq("id", me).limit(SEARCH_LIMIT).execute()
     return res.data or []
 
-@st.cache_data(ttl=5)
-def my_friend_requests():
-    incoming = auth.table("friends").select("id, requester_id, addressee_id, status, created_at")\
-        .eq("addressee_id", me).eq("status", "pending").order("created_at").execute().data or []
-    outgoing = auth.table("friends").select("id, requester_id, addressee_id, status, created_at")\
-        .eq("requester_id", me).eq("status", "pending").order("created_at").execute().data or []
+def find_users(_auth_cli, me: str, query: str) -> list:
+    """
+    search_users on the normalized query, skipping queries too short to be useful.
+    If the last (recent, untruncated) result was for a substring of this query, every match
+    for this query is already in it, so it is narrowed locally instead of queried again.
+    """
+    # "*" is PostgREST's own wildcard and can't be escaped; drop it so both sides match literally
+    q = query.replace("*", "").strip().lower()
+    if len(q) < SEARCH_MIN_CHARS:
+        return []
+    prev = st.session_state.get("_last_search")
+    if prev and prev[0] in q and len(prev[1]) < SEARCH_LIMIT and time.time() - prev[2] < SEARCH_TTL:
+        rows = [r for r in prev[1]
+                if q in (r.get("username") or "").lower() or q in (r.get("full_name") or "").lower()]
+        fetched_at = prev[2]
+    else:
+        rows, fetched_at = search_users(_auth_cli, me, q), time.time()
+    st.session_state["_last_search"] = (q, rows, fetched_at)
+    return rows
+
+@st.cache_data(ttl=5, max_entries=MAX_ACTIVE_USERS, show_spinner=False)
+def my_friend_requests(_auth_cli, me: str):
+    rows = _auth_cli.table("friends").select("id, requester_id, addressee_id, status, created_at")\
+        .or_(f"addressee_id.eq.{me},requester_id.eq.{me}").eq("status", "pending").order("created_at").execute().data or []
+    incoming = [r for r in rows if r["addressee_id"] == me]
+    outgoing = [r for r in rows if r["requester_id"] == me]
     return incoming, outgoing
 
-@st.cache_data(ttl=10)
-def my_friends():
-    acc1 = auth.table("friends").select("requester_id, addressee_id").eq("requester_id", me).eq("status", "accepted").execute().data or []
-    acc2 = auth.table("friends").select("requester_id, addressee_id").eq("addressee_id", me).eq("status", "accepted").execute().data or []
-    ids = {r["addressee_id"] for r in acc1} | {r["requester_id"] for r in acc2}
+@st.cache_data(ttl=10, max_entries=MAX_ACTIVE_USERS, show_spinner=False)
+def my_friends(_auth_cli, me: str):
+    rows = _auth_cli.table("friends").select("requester_id, addressee_id")\
+        .or_(f"requester_id.eq.{me},addressee_id.eq.{me}").eq("status", "accepted").execute().data or []
+    ids = {r["requester_id"] if r["addressee_id"] == me else r["addressee_id"] for r in rows}
     ids.discard(me)
     if not ids: return []
-    return auth.table("profiles").select("id, username, full_name, avatar_url").in_("id", list(ids)).execute().data or []
-
-def usernames_for_ids(ids):
-    ids = list(ids or [])
-    if not ids: return {}
-    rows = auth.table("profiles").select("id, username").in_("id", ids).execute().data or []
-    return {r["id"]: (r["username"] or r["id"][:8]) for r in rows}
+    return _auth_cli.table("profiles").select("id, username, full_name, avatar_url").in_("id", list(ids)).execute().data or []
 
-def profiles_for_ids(ids):
-    ids = list(ids or [])
+@st.cache_data(ttl=30, max_entries=2 * MAX_ACTIVE_USERS)  # page lookup + thread stragglers per user
+def resolve_profiles(_auth_cli, ids: tuple) -> dict:
+    """
+    One batched lookup for every user id a rerun needs: {id: {id, username, avatar_url}}.
+    Pass tuple(sorted(ids)): cache_data hashes a set in iteration order, so equal sets could miss.
+    """
     if not ids: return {}
-    rows = auth.table("profiles").select("id, username, avatar_url").in_("id", ids).execute().data or []
+    rows = _auth_cli.table("profiles").select("id, username, avatar_url").in_("id", list(ids)).execute().data or []
     return {r["id"]: r for r in rows}
 
 def send_friend_request(other_id: str):
@@ -279,93 +557,362 @@ def send_friend_request(other_id: str):
         # fallback: simple insert
         auth.table("friends").insert({"requester_id": me, "addressee_id": other_id, "status": "pending"}).execute()
 
-def update_request_status(req_id: int, new_status: str):
-    auth.table("friends").update({"status": new_status}).eq("id", req_id).execute()
+def update_request_status_many(req_ids: list[int], new_status: str):
+    if not req_ids: return
+    auth.table("friends").update({"status": new_status}).in_("id", req_ids).execute()
 
 def get_or_create_conversation(other_id: str) -> str:
     if other_id == me:
         st.error("You can’t start a conversation with yourself.")
         raise RuntimeError("self-conversation blocked in UI")
-    resp = auth.rpc("get_or_create_conversation", {"a": me, "b": other_id}).execute()
-    if not resp.data: raise RuntimeError("RPC returned no data")
-    return resp.data
+    # Conversation ids never change once created; remember them for the session
+    cache = st.session_state.setdefault("_convo_cache", {})
+    key = (me, other_id)
+    if key not in cache:
+        resp = auth.rpc("get_or_create_conversation", {"a": me, "b": other_id}).execute()
+        if not resp.data: raise RuntimeError("RPC returned no data")
+        cache[key] = resp.data
+    return cache[key]
 
 def create_group(others: list[str], title: str) -> str:
     resp = auth.rpc("create_group_conversation", {"creator": me, "members": others, "conv_title": title}).execute()
     if not resp.data: raise RuntimeError("RPC returned no data")
     return resp.data
 
-@st.cache_data(ttl=5)
-def my_conversations():
-    cps = auth.table("conversation_participants").select("conversation_id").eq("user_id", me).execute().data or []
-    conv_ids = [c["conversation_id"] for c in cps]
-    if not conv_ids: return []
-    convs = auth.table("conversations").select("id, title, is_group, created_at, creator_id")\
-        .in_("id", conv_ids).order("created_at", desc=True).execute().data or []
-    members = auth.table("conversation_participants").select("conversation_id, user_id")\
-        .in_("conversation_id", conv_ids).execute().data or []
-    byconv = {}
-    for m in members:
-        byconv.setdefault(m["conversation_id"], []).append(m["user_id"])
-    for c in convs:
-        c["members"] = byconv.get(c["id"], [])
-    return convs
-
-def convo_label(convo, usernames_map):
+@st.cache_data(ttl=5, max_entries=MAX_ACTIVE_USERS, show_spinner=False)
+def my_conversations(_auth_cli, me: str):
+    # Server-side join: conversations + member ids in one round trip (see schema.sql)
+    return _auth_cli.rpc("my_conversations_with_members", {"uid": me}).execute().data or []
+
+@st.cache_data(ttl=300, max_entries=MAX_ACTIVE_USERS)
+def build_conv_options(me: str, convs_sig: tuple, members_sig: tuple) -> dict:
+    """{conversation_id: label HTML} from (id, is_group, title, members) and (uid, username, avatar_url) tuples."""
+    uname_map = {uid: (uname or short(uid)) for uid, uname, _ in members_sig}
+    prof_map = {uid: {"avatar_url": url} for uid, _, url in members_sig}
+    member_html = member_snippets(uname_map.keys(), uname_map, prof_map)
+    out = {}
+    for cid, is_group, title, members in convs_sig:
+        convo = {"id": cid, "is_group": is_group, "title": title, "members": list(members)}
+        out[cid] = f"{convo_label_with_avatar(convo, member_html)} · {cid[:6]}"
+    return out
+
+def fetch_conversation(cid: str) -> dict | None:
+    rows = auth.table("conversations").select("id, title, is_group, created_at, creator_id")\
+        .eq("id", cid).limit(1).execute().data or []
+    if not rows: return None
+    conv = rows[0]
+    members = auth.table("conversation_participants").select("user_id").eq("conversation_id", cid).execute().data or []
+    conv["members"] = [m["user_id"] for m in members]
+    return conv
+
+def remember_conversation(cid: str):
+    """Patch a just-opened conversation into this session's list instead of refetching all of them."""
+    conv = fetch_conversation(cid)
+    if conv:
+        st.session_state.setdefault("convos_cache", {})[cid] = conv
+
+def list_conversations(me: str) -> list:
+    """my_conversations() plus any conversation opened since its cache entry was filled."""
+    convs = my_conversations(auth, me)
+    pending = st.session_state.get("convos_cache")
+    if not pending: return convs
+    known = {c["id"] for c in convs}
+    for cid in known & pending.keys():
+        del pending[cid]  # the cached list has caught up
+    return list(pending.values()) + convs
+
+def member_snippets(member_ids, usernames_map, profile_map) -> dict:
+    """{uid: (handle_html, avatar_html)} rendered once per member, shared by every label."""
+    out = {}
+    for uid in member_ids:
+        url = profile_map.get(uid, {}).get("avatar_url")
+        out[uid] = (f"@{_esc(usernames_map.get(uid, short(uid)))}", avatar_img(url, 18) if url else "")
+    return out
+
+def convo_label_with_avatar(convo, member_html) -> str:
+    members = convo.get("members", [])
     if convo.get("is_group"):
-        name = (convo.get("title") or "").strip()
-        if name:
-            return f"👥 {name}"
-        others = [u for u in convo.get("members", []) if u != me]
-        handles = [f"@{usernames_map.get(u, u[:8])}" for u in others][:3]
-        tail = "" if len(others) <= 3 else f" +{len(others)-3}"
-        return "👥 " + ", ".join(handles) + tail
-    # DM: show other
-    others = [u for u in convo.get("members", []) if u != me]
-    if not others: return "💬 DM"
-    other = others[0]
-    return f"💬 @{usernames_for_ids([other]).get(other, other[:8])}"
-
-def convo_label_with_avatar(convo, usernames_map, profile_map) -> str:
-    if convo.get("is_group"):
-        others = [u for u in convo.get("members", [])]
-        urls = [profile_map.get(u, {}).get("avatar_url") for u in others][:2]
-        imgs = "".join(f"<span style='margin-right:-6px;'>{avatar_img(u, 18)}</span>" for u in urls if u)
-        base = (convo.get("title") or "").strip()
+        imgs = "".join(f"<span style='margin-right:-6px;'>{a}</span>" for _, a in (member_html[u] for u in members[:2]) if a)
+        base = _esc((convo.get("title") or "").strip())
         if not base:
-            handles = [f"@{usernames_map.get(u, u[:8])}" for u in others if u != me][:3]
-            tail = "" if len(others) <= 3 else f" +{len(others)-3}"
+            handles = [member_html[u][0] for u in members if u != me][:3]
+            tail = "" if len(members) <= 3 else f" +{len(members)-3}"
             base = ", ".join(handles) + tail if handles else "Group"
-        return f"{imgs} <span>👥 {py_html.escape(base)}</span>"
+        return f"{imgs} <span>👥 {base}</span>"
     # DM
-    others = [u for u in convo.get("members", []) if u != me]
-    other = others[0] if others else None
+    other = next((u for u in members if u != me), None)
     if not other:
         return f"{avatar_img(None, 18)} <span>💬 DM</span>"
-    return f"{avatar_img(profile_map.get(other, {}).get('avatar_url'), 18)} <span>💬 @{py_html.escape(usernames_map.get(other, other[:8]))}</span>"
+    handle, avatar = member_html[other]
+    return f"{avatar or avatar_img(None, 18)} <span>💬 {handle}</span>"
+
+MESSAGES_PAGE = 50
+
+def message_window(cid: str) -> int:
+    """How many of the newest messages to fetch and render; grows by a page on "Load more"."""
+    return st.session_state.setdefault("msg_window", {}).get(cid, MESSAGES_PAGE)
+
+def grow_message_window(cid: str):
+    st.session_state["msg_window"][cid] = message_window(cid) + MESSAGES_PAGE
+
+MESSAGES_REFRESH_SECONDS = 60  # delta-fetch at least this often, even if no version bump arrived
+# created_at is the transaction start, so a row can commit after a later-stamped one was read;
+# each delta re-reads this far behind the newest row seen
+MESSAGES_DELTA_OVERLAP = timedelta(seconds=5)
+
+# Only used for a thread's first page (or a larger window); `version` just feeds the cache key
+@st.cache_data(ttl=60, max_entries=32)
+def load_messages(_auth_cli, conversation_id: str, limit: int = MESSAGES_PAGE, version: int = 0):
+    """Newest `limit` messages, returned oldest-first."""
+    res = _auth_cli.table("direct_messages").select("id, sender_id, content, created_at")\
+        .eq("conversation_id", conversation_id).order("created_at", desc=True).limit(limit).execute()
+    return _normalize_ts(list(reversed(res.data or [])))
+
+def _normalize_ts(rows: list) -> list:
+    for m in rows:
+        if m["created_at"].endswith("Z"):
+            m["created_at"] = m["created_at"][:-1] + "+00:00"
+    return rows
+
+def load_messages_since(_auth_cli, conversation_id: str, since_ts: str | None) -> list:
+    """Messages at or after `since_ts` (all if None), oldest-first; gte so rows sharing the last timestamp aren't missed."""
+    q = _auth_cli.table("direct_messages").select("id, sender_id, content, created_at").eq("conversation_id", conversation_id)
+    if since_ts:
+        q = q.gte("created_at", since_ts)
+    return _normalize_ts(q.order("created_at").execute().data or [])
+
+def thread_messages(_auth_cli, conversation_id: str, limit: int, version: int) -> list:
+    """
+    Newest `limit` messages, oldest-first, kept per conversation in the session.
+    The first load (or a larger window) fetches the page; after that a version bump, or
+    MESSAGES_REFRESH_SECONDS without one (realtime can be silently dead), only fetches rows
+    from MESSAGES_DELTA_OVERLAP before the newest one seen and merges in those it lacks.
+    """
+    cache = st.session_state.setdefault("msgs_cache", {})
+    entry = cache.get(conversation_id)
+    now = time.time()
+    if entry is None or entry["limit"] < limit:
+        rows = list(load_messages(_auth_cli, conversation_id, limit=limit, version=version))
+        entry = cache[conversation_id] = {"rows": rows, "limit": limit, "version": version, "fetched_at": now}
+    elif entry["version"] != version or now - entry["fetched_at"] >= MESSAGES_REFRESH_SECONDS:
+        rows = entry["rows"]
+        seen = {m["id"] for m in rows}
+        since = (_parse_ts(rows[-1]["created_at"]) - MESSAGES_DELTA_OVERLAP).isoformat() if rows else None
+        new = [m for m in load_messages_since(_auth_cli, conversation_id, since) if m["id"] not in seen]
+        if new:
+            rows.extend(new)
+            rows.sort(key=lambda m: m["created_at"])  # a late commit can land before rows we had
+            del rows[:-limit]
+        entry["version"], entry["fetched_at"] = version, now
+    return entry["rows"][-limit:]
 
-@st.cache_data(ttl=2)
-def load_messages(conversation_id: str, limit: int = 200):
-    res = auth.table("direct_messages").select("id, sender_id, content, created_at")\
-        .eq("conversation_id", conversation_id).order("created_at").limit(limit).execute()
-    return res.data or []
+# =========================
+# Realtime (new-message push)
+# =========================
+MESSAGES_POLL_SECONDS = 2  # fallback cadence when realtime is unavailable
+
+@st.cache_resource(show_spinner=False)
+def _realtime_loop() -> asyncio.AbstractEventLoop:
+    # The sync client has no realtime support; run the async one on a background loop
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource(show_spinner=False)
+def message_versions() -> dict:
+    """{conversation_id: insert counter}, bumped from realtime callbacks."""
+    return {}
 
-def send_message_to_db(conversation_id: str, text: str) -> bool:
+RT_RETRY_SECONDS = 30  # wait before reconnecting / rejoining after a realtime failure
+RT_JOIN_TIMEOUT = 10   # seconds for the socket connect + join to be sent
+
+async def _realtime_connect(access_token: str):
+    cli = await acreate_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+    await cli.realtime.set_auth(access_token)  # RLS decides which inserts we are told about
+    return cli
+
+async def _realtime_subscribe(rt_cli, cid: str, versions: dict, on_state):
+    def _on_insert(_payload):
+        versions[cid] = versions.get(cid, 0) + 1
+    return await rt_cli.channel(f"convo-{cid}").on_postgres_changes(
+        "INSERT", callback=_on_insert, schema="public", table="direct_messages", filter=f"conversation_id=eq.{cid}"
+    ).subscribe(on_state)
+
+async def _realtime_join(conn: dict, cid: str, attempt: int, versions: dict, states: dict, old_channel):
+    """
+    Runs on the event loop: (re)join a conversation's channel and report through `states`.
+    Nothing here may reference the _Realtime object, or its finalizer could never run.
+    """
+    def _on_state(new_state, _err=None):
+        states[cid] = (new_state, time.time(), attempt)
+    async def _join():
+        # shield: timing out this join must not cancel the connect other joins share
+        cli = await asyncio.shield(asyncio.wrap_future(conn["cli"]))
+        if old_channel is not None:
+            try:
+                await old_channel.unsubscribe()
+            except Exception:
+                pass
+        return await _realtime_subscribe(cli, cid, versions, _on_state)
     try:
-        auth.table("direct_messages").insert({
-            "conversation_id": conversation_id,
-            "sender_id": me,
-            "content": text.strip()
-        }).execute()
-        return True
-    except APIError:
+        return await asyncio.wait_for(_join(), RT_JOIN_TIMEOUT)
+    except Exception:
+        _on_state(RealtimeSubscribeStates.CHANNEL_ERROR)
+        raise
+
+async def _realtime_set_auth(conn: dict, token: str):
+    cli = await asyncio.wrap_future(conn["cli"])
+    await cli.realtime.set_auth(token)
+
+def _close_realtime(loop, conn: dict):
+    # Also runs as a finalizer when the session is dropped: schedule the close, don't wait on it
+    fut = conn["cli"]
+    if not fut.done():
+        fut.cancel()
+    elif not fut.cancelled() and fut.exception() is None:
+        asyncio.run_coroutine_threadsafe(fut.result().realtime.close(), loop)
+
+class _Realtime:
+    """
+    A session's realtime socket plus one INSERT channel per watched conversation.
+    Nothing here waits on the network: connects and joins are scheduled on the loop, and
+    results come back through the plain `_states` dict that the status callbacks write.
+    """
+    def __init__(self, sender_id: str, token: str):
+        self.sender_id = sender_id
+        self._loop = _realtime_loop()
+        self._token = token
+        self._conn = {}      # "cli" -> future of the connected client; shared with loop-side coroutines
+        self._connect()
+        self._joins = {}     # cid -> (attempt, future of the joined channel)
+        self._states = {}    # cid -> (RealtimeSubscribeStates, time it was reported, attempt)
+        self._attempts = itertools.count(1)
+        self._finalizer = weakref.finalize(self, _close_realtime, self._loop, self._conn)
+
+    def _connect(self):
+        self._conn["cli"] = asyncio.run_coroutine_threadsafe(_realtime_connect(self._token), self._loop)
+        self._connected_at = time.time()
+
+    def close(self):
+        self._finalizer()
+
+    def set_token(self, token: str):
+        """Re-auth the socket when the client has rotated the access token, so channels outlive expiry."""
+        if token and token != self._token:
+            self._token = token
+            asyncio.run_coroutine_threadsafe(_realtime_set_auth(self._conn, token), self._loop)
+
+    def watch(self, cid: str, versions: dict) -> bool:
+        """True once the conversation's channel is joined; False (poll) while joining or after a failure."""
+        attempt, join = self._joins.get(cid, (None, None))
+        state, at, state_attempt = self._states.get(cid, (None, 0, None))
+        if state_attempt != attempt:
+            state = None  # a late report from a channel we already replaced
+        if state == RealtimeSubscribeStates.SUBSCRIBED:
+            return True
+        if join is not None and (state is None or time.time() - at < RT_RETRY_SECONDS):
+            return False  # join in flight, or CHANNEL_ERROR/TIMED_OUT/CLOSED recently
+        cli = self._conn["cli"]
+        if not cli.done() or cli.cancelled() or cli.exception() is not None:
+            # Connect failed or is stuck: retry it, at most every RT_RETRY_SECONDS
+            if time.time() - self._connected_at < RT_RETRY_SECONDS and join is not None:
+                return False
+            if join is not None:
+                cli.cancel()
+                self._connect()
+        old_channel = None
+        if join is not None and join.done() and not join.cancelled() and join.exception() is None:
+            old_channel = join.result()
+        attempt = next(self._attempts)
+        self._joins[cid] = (attempt, asyncio.run_coroutine_threadsafe(
+            _realtime_join(self._conn, cid, attempt, versions, self._states, old_channel), self._loop
+        ))
         return False
 
+def _current_token() -> str:
+    """The live access token (the cached client auto-refreshes it); the login token until then."""
+    try:
+        sess = auth.auth.get_session()
+    except Exception:
+        sess = None
+    return getattr(sess, "access_token", None) or access_token
+
+def session_realtime() -> _Realtime:
+    """This session's _Realtime, rebuilt for a different user."""
+    rt = st.session_state.get("_rt")
+    if rt is not None and rt.sender_id != me:
+        rt.close()
+        rt = None
+    if rt is None:
+        rt = st.session_state["_rt"] = _Realtime(me, _current_token())
+    return rt
+
+def watch_messages(cid: str) -> bool:
+    """Keep a realtime channel for a conversation. False means the caller should poll."""
+    rt = session_realtime()
+    try:
+        rt.set_token(_current_token())
+        return rt.watch(cid, message_versions())
+    except Exception:
+        return False
+
+def messages_version(cid: str) -> int:
+    if watch_messages(cid):
+        return message_versions().get(cid, 0)
+    return int(time.time() // MESSAGES_POLL_SECONDS)  # same freshness as the old 2s TTL
+
+MAX_MESSAGE_CHARS = 2000  # matches the direct_messages.content check constraint
+
+def send_message_to_db(conversation_id: str, content: str, temp_id: str):
+    """Queue the (already normalized) insert for the background writer; status lands on a later rerun."""
+    st.session_state["outbox"].put((conversation_id, content, temp_id))
+
+# =========================
+# Concurrent fetches
+# =========================
+def _submit(pool: ThreadPoolExecutor, fn, *args, **kwargs):
+    """
+    Run a cached data helper on `pool` with this script run's context attached.
+    Submitted helpers only return data (no session_state) and use show_spinner=False.
+    """
+    ctx = get_script_run_ctx()
+    def _call():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    return pool.submit(_call)
+
 # =========================
 # Layout: Left / Center / Right
 # =========================
 col_left, col_main, col_right = st.columns([1, 2, 1])
 
+# Fetch what the page needs up front, concurrently, so the page waits ~one round trip
+# instead of the sum; then every id -> profile resolution is one query.
+# The pool lives for this run only, so one session never queues behind another's fetches.
+_open_convo = st.session_state.get("select_convo") or st.session_state.get("current_convo")
+with ThreadPoolExecutor(max_workers=3, thread_name_prefix="fetch") as _pool:
+    f_requests = _submit(_pool, my_friend_requests, auth, me)
+    f_convs = _submit(_pool, my_conversations, auth, me)
+    f_friends = _submit(_pool, my_friends, auth, me)
+    # The thread keeps its cache in session_state, so it loads here on the script thread meanwhile
+    server_msgs = thread_messages(
+        auth, _open_convo, limit=message_window(_open_convo), version=messages_version(_open_convo)
+    ) if _open_convo else []
+    incoming, outgoing = f_requests.result()
+    f_convs.result()  # warms the cache list_conversations reads
+    friends = f_friends.result()
+convs = list_conversations(me)
+conv_by_id = {c["id"]: c for c in convs}
+all_member_ids = set(itertools.chain.from_iterable(c.get("members", ()) for c in convs))
+# My own entry comes from the session profile, so only other users are looked up
+people = resolve_profiles(auth, tuple(sorted(
+    ({r["requester_id"] for r in incoming}
+     | {r["addressee_id"] for r in outgoing}
+     | all_member_ids
+     | {m["sender_id"] for m in server_msgs}) - {me}
+)))
+people = {**people, me: {"id": me, "username": profile["username"], "avatar_url": profile.get("avatar_url")}}
+
 # ---------- Left: Friends & Conversations ----------
 with col_left:
     st.subheader("👥 Friends & Conversations")
@@ -373,129 +920,222 @@ with col_left:
     # Find users
     with st.expander("Find users"):
         q = st.text_input("Search", "", placeholder="username or name")
-        results = search_users(q) if q else []
+        results = find_users(auth, me, q)
+        if q.strip() and not results and len(q.strip()) < SEARCH_MIN_CHARS:
+            st.caption(f"Type at least {SEARCH_MIN_CHARS} characters.")
         for r in results:
             if r["id"] == me: continue
-            name = r.get("full_name") or r.get("username") or r["id"][:8]
-            handle = r.get("username") or r["id"][:8]
             cols = st.columns([2,1])
             cols[0].markdown(
-                f"{avatar_img(r.get('avatar_url'), 24)} **{py_html.escape(name)}**  \n`@{py_html.escape(handle)}`",
+                f"{avatar_img(r.get('avatar_url'), 24)} **{_esc(display_name(r))}**  \n`@{_esc(user_handle(r))}`",
                 unsafe_allow_html=True
             )
             if cols[1].button("Add", key=f"add_{r['id']}"):
                 send_friend_request(r["id"])
                 st.success("Request sent")
-                st.cache_data.clear()
+                my_friend_requests.clear()
 
     # Friend requests
     with st.expander("Requests"):
-        incoming, outgoing = my_friend_requests()
         st.markdown("**Incoming**")
         if not incoming:
             st.caption("None")
-        for req in incoming:
-            rid = req["id"]; from_id = req["requester_id"]
-            prof = profiles_for_ids([from_id]).get(from_id, {})
-            uname = prof.get("username") or from_id[:8]
-            cols = st.columns([2,1,1])
-            cols[0].markdown(f"{avatar_img(prof.get('avatar_url'), 20)} @{py_html.escape(uname)}", unsafe_allow_html=True)
-            if cols[1].button("Accept", key=f"acc_{rid}"):
-                update_request_status(rid, "accepted"); st.cache_data.clear()
-            if cols[2].button("Decline", key=f"dec_{rid}"):
-                update_request_status(rid, "declined"); st.cache_data.clear()
+        else:
+            all_ids = [req["id"] for req in incoming]
+            bulk = st.columns(2)
+            if bulk[0].button("Accept all", key="acc_all"):
+                update_request_status_many(all_ids, "accepted")
+                my_friend_requests.clear(); my_friends.clear()
+                st.rerun()
+            if bulk[1].button("Decline all", key="dec_all"):
+                update_request_status_many(all_ids, "declined")
+                my_friend_requests.clear()
+                st.rerun()
+            # One form for all requests: a single widget each, one UPDATE per outcome on submit
+            with st.form("reqs"):
+                choices = {}
+                for req in incoming:
+                    rid = req["id"]; from_id = req["requester_id"]
+                    prof = people.get(from_id, {})
+                    uname = prof.get("username") or short(from_id)
+                    cols = st.columns([1,1])
+                    cols[0].markdown(f"{avatar_img(prof.get('avatar_url'), 20)} @{_esc(uname)}", unsafe_allow_html=True)
+                    choices[rid] = cols[1].radio(
+                        "Action", ["—", "Accept", "Decline"], key=f"req_{rid}", horizontal=True, label_visibility="collapsed"
+                    )
+                if st.form_submit_button("Apply"):
+                    accept_ids = [rid for rid, c in choices.items() if c == "Accept"]
+                    decline_ids = [rid for rid, c in choices.items() if c == "Decline"]
+                    update_request_status_many(accept_ids, "accepted")
+                    update_request_status_many(decline_ids, "declined")
+                    my_friend_requests.clear()
+                    if accept_ids: my_friends.clear()
+                    st.rerun()  # drop the handled requests from the list now
         st.markdown("---")
         st.markdown("**Outgoing**")
         if not outgoing:
             st.caption("None")
         for req in outgoing:
             to_id = req["addressee_id"]
-            prof = profiles_for_ids([to_id]).get(to_id, {})
-            uname = prof.get("username") or to_id[:8]
-            st.caption(f"{avatar_img(prof.get('avatar_url'), 16)} Sent to @{py_html.escape(uname)} (pending)", unsafe_allow_html=True)
+            prof = people.get(to_id, {})
+            uname = prof.get("username") or short(to_id)
+            st.caption(f"{avatar_img(prof.get('avatar_url'), 16)} Sent to @{_esc(uname)} (pending)", unsafe_allow_html=True)
 
     # Quick DM from friends
     with st.expander("Friends"):
-        friends = my_friends()
         if not friends:
             st.caption("No friends yet")
         else:
             for f in friends:
                 fid = f["id"]
-                label = f.get("full_name") or f.get("username") or fid[:8]
                 cols = st.columns([2,1])
                 cols[0].markdown(
-                    f"{avatar_img(f.get('avatar_url'), 24)} **{py_html.escape(label)}**  \n`@{py_html.escape(f.get('username') or fid[:8])}`",
+                    f"{avatar_img(f.get('avatar_url'), 24)} **{_esc(display_name(f))}**  \n`@{_esc(user_handle(f))}`",
                     unsafe_allow_html=True
                 )
                 if cols[1].button("DM", key=f"dm_{fid}"):
                     try:
                         convo_id = get_or_create_conversation(fid)
                         st.session_state["current_convo"] = convo_id
-                        st.cache_data.clear()
+                        remember_conversation(convo_id)
                     except Exception:
                         st.error("Could not open DM")
+                    else:
+                        # data for this run was fetched up front; select it and start over
+                        st.session_state["select_convo"] = convo_id
+                        st.rerun()
 
     # New group
     with st.expander("New group"):
-        friends = my_friends()
         if not friends:
             st.caption("Add friends first to create a group.")
         else:
-            friend_id_to_label = {f["id"]: (f.get("full_name") or f.get("username") or f["id"][:8]) for f in friends}
+            friend_id_to_label = {f["id"]: display_name(f) for f in friends}
+            friend_username = {f["id"]: user_handle(f) for f in friends}
             chosen = st.multiselect(
                 "Pick at least 2:",
                 options=list(friend_id_to_label.keys()),
-                format_func=lambda i: f'{friend_id_to_label[i]} (@{next((f["username"] for f in friends if f["id"]==i), i[:8])})'
+                format_func=lambda i: f'{friend_id_to_label[i]} (@{friend_username[i]})'
             )
             group_title = st.text_input("Group name (optional)", "")
             if st.button("Create", type="primary", disabled=len(chosen) < 2):
                 try:
                     convo_id = create_group(chosen, group_title)
-                    st.success("Group created")
                     st.session_state["current_convo"] = convo_id
-                    st.cache_data.clear()
+                    remember_conversation(convo_id)
                 except Exception:
                     st.error("Failed to create group")
+                else:
+                    st.toast("Group created")  # toasts survive the rerun, st.success would not
+                    st.session_state["select_convo"] = convo_id
+                    st.rerun()
 
     st.markdown("---")
 
     # Conversation list (DMs + Groups)
-    convs = my_conversations()
     st.markdown("**Your conversations**")
     if not convs:
         st.caption("No conversations yet.")
     else:
-        all_member_ids = {u for c in convs for u in c.get("members", [])}
-        uname_map = usernames_for_ids(all_member_ids)
-        prof_map = profiles_for_ids(list(all_member_ids))
-        conv_options = {}
-        for c in convs:
-            conv_options[c["id"]] = f"{convo_label_with_avatar(c, uname_map, prof_map)} · {c['id'][:6]}"
+        # Labels are a pure function of these signatures, so an unchanged sidebar is a cache hit
+        convs_sig = tuple((c["id"], c.get("is_group"), c.get("title"), tuple(c.get("members", []))) for c in convs)
+        members_sig = tuple(sorted(
+            # every member id was already part of the batched `people` lookup
+            (uid, people.get(uid, {}).get("username"), people.get(uid, {}).get("avatar_url")) for uid in all_member_ids
+        ))
+        conv_options = build_conv_options(me, convs_sig, members_sig)
 
         conv_ids = list(conv_options.keys())
+        # The selectbox is driven only through its key (DM/Create write it too); passing
+        # index= as well makes Streamlit warn about a default plus a Session State value
         current = st.session_state.get("current_convo")
-        default_index = conv_ids.index(current) if current in conv_ids else 0
+        st.session_state.setdefault("select_convo", current if current in conv_options else conv_ids[0])
+        if st.session_state["select_convo"] not in conv_options:
+            st.session_state["select_convo"] = conv_ids[0]  # e.g. a convo the list no longer has
 
         # selectbox can't render HTML; we show a plain label in the select and pretty HTML below it
         def _plain_label(cid: str) -> str:
             # strip tags for the selectbox display
-            import re as _re
-            return _re.sub(r"<[^>]+>", "", conv_options.get(cid, cid[:8]))
+            return _RE_TAGS.sub("", conv_options.get(cid, short(cid)))
 
         selected_convo_id = st.selectbox(
             "Open",
             conv_ids,
-            index=default_index if conv_ids else 0,
             format_func=_plain_label,
             key="select_convo",
         )
         st.session_state["current_convo"] = selected_convo_id
 
-        st.markdown(conv_options.get(selected_convo_id, selected_convo_id[:8]), unsafe_allow_html=True)
+        st.markdown(conv_options.get(selected_convo_id, short(selected_convo_id)), unsafe_allow_html=True)
 
         if st.button("Refresh"):
-            st.cache_data.clear()
+            # Only conversations and messages are live; profiles/friends keep their caches
+            load_messages.clear(); my_conversations.clear()
+            st.session_state.pop("msgs_cache", None)
+            st.rerun()
+
+# Thread panel as a fragment: it polls on its own (picking up realtime/outbox changes)
+# without re-running the friends/conversations half of the page
+THREAD_POLL_SECONDS = 3
+
+@st.fragment(run_every=THREAD_POLL_SECONDS)
+def messages_panel(cid: str):
+    apply_outbox_status()
+
+    # Load the newest `window` messages, then merge with optimistic
+    window = message_window(cid)
+    server_msgs = thread_messages(auth, cid, limit=window, version=messages_version(cid))
+    # Button actions are on_click callbacks: they run before the rerun the click triggers,
+    # whether Streamlit runs just this fragment or merges the click into a full rerun
+    if len(server_msgs) >= window:
+        st.button(f"Load {MESSAGES_PAGE} more", on_click=grow_message_window, args=(cid,))
+    msgs = combined_messages(cid, server_msgs)[-window:]
+    # Senders new since the last full run; cached, so ids with no profile aren't re-queried every poll
+    missing = {m["sender_id"] for m in msgs} - people.keys()
+    sender_profiles = {**people, **resolve_profiles(auth, tuple(sorted(missing)))} if missing else people
+    id_map = {uid: (p["username"] or short(uid)) for uid, p in sender_profiles.items()}
+
+    # Scrollable messages panel (batched markdown, no iframe)
+    st.markdown("**Thread**")
+    stamps = [_fmt_ts(m["created_at"]) for m in msgs]
+    # Per-sender (role, label, avatar, avatar html), computed once per sender rather than per message
+    senders = {}
+    for uid in {m["sender_id"] for m in msgs}:
+        url = sender_profiles.get(uid, {}).get("avatar_url")
+        senders[uid] = ("user" if uid == me else "assistant",
+                        "You" if uid == me else f"@{id_map.get(uid, short(uid))}",
+                        avatar_src(url) or None,
+                        avatar_img(url))
+    with st.container(height=520):
+        if not msgs:
+            st.caption("No messages yet. Say hi!")
+        # Static messages are batched into one markdown element; only a failed message
+        # of ours needs widgets, so it flushes the batch and renders on its own
+        parts = []
+        for m, ts in zip(msgs, stamps):
+            role, who, avatar, avatar_html = senders[m["sender_id"]]
+            status = m.get("status")
+            if status == "failed" and role == "user":
+                if parts:
+                    st.markdown("\n".join(parts), unsafe_allow_html=True)
+                    parts = []
+                with st.chat_message(role, avatar=avatar):
+                    st.markdown(f"**{who}** · {ts} {_BADGES[status]}")
+                    st.write(m["content"] or "")
+                    cols = st.columns(2)
+                    cols[0].button("Retry", key=f"retry_{m['id']}", on_click=retry_optimistic, args=(cid, m["id"]))
+                    cols[1].button("Dismiss", key=f"dismiss_{m['id']}", on_click=dismiss_optimistic, args=(cid, m["id"]))
+                continue
+            # One line per message: a blank line (\n, \r\n or a bare \r) would end the HTML
+            # block mid-message and let the rest render as markdown
+            body = "<br>".join(_esc(m["content"] or "").splitlines())
+            parts.append(
+                f"<div style='display:flex;gap:10px;margin:8px 0;'>{avatar_html}"
+                f"<div><div><b>{_esc(who)}</b> · <span style='opacity:.6'>{ts}</span> {_BADGES.get(status, '')}</div>"
+                f"<div>{body}</div></div></div>"
+            )
+        if parts:
+            st.markdown("\n".join(parts), unsafe_allow_html=True)
 
 # ---------- Center: Messages ----------
 with col_main:
@@ -505,91 +1145,23 @@ with col_main:
         st.caption("Pick a conversation from the left.")
         st.stop()
 
-    # Load from DB then merge with optimistic
-    server_msgs = load_messages(current_convo)
-    msgs = combined_messages(current_convo, server_msgs)
-    id_map = usernames_for_ids({m["sender_id"] for m in msgs} | {me})
-    sender_profiles = profiles_for_ids(list({m["sender_id"] for m in msgs}))
-
-    # Scrollable messages panel (HTML iframe)
-    st.markdown("**Thread**")
-    items = []
-    for m in msgs:
-        mine = (m["sender_id"] == me)
-        who = "You" if mine else f"@{id_map.get(m['sender_id'], m['sender_id'][:8])}"
-        ts = datetime.fromisoformat(m["created_at"].replace("Z", "+00:00"))\
-             .astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
-        status = m.get("status")
-        badge_text = "⏳ sending" if status == "sending" else ("✅ sent" if status == "sent" else ("⚠️ failed" if status == "failed" else ""))
-        badge_html = f"<span class='badge'>{badge_text}</span>" if badge_text else ""
-        bubble = "🟦" if mine else "🟨"
-        avatar_url = sender_profiles.get(m["sender_id"], {}).get("avatar_url") or ""
-
-        items.append(f"""
-          <div class="msg {'mine' if mine else 'theirs'}">
-            <div class="row">
-              <img src="{py_html.escape(avatar_url)}" class="avatar"/>
-              <div class="content">
-                <div class="meta">{bubble} <strong>{py_html.escape(who)}</strong> · {py_html.escape(ts)} {badge_html}</div>
-                <div class="body">{py_html.escape(m['content'] or '')}</div>
-              </div>
-            </div>
-          </div>
-        """)
-
-    messages_html = f"""
-<!doctype html>
-<html>
-<head>
-<meta charset="utf-8" />
-<style>
-  body {{ margin:0; font-family: system-ui, -apple-system, Segoe UI, Roboto, Arial, sans-serif; }}
-  .wrap {{
-    height: 100%;
-    max-height: 520px;
-    overflow-y: auto;
-    padding: 12px 16px;
-    background: #fafafa;
-    border: 1px solid #e6e6e6;
-    border-radius: 12px;
-  }}
-  .msg {{ padding: 8px 0; border-bottom: 1px solid #eee; }}
-  .msg:last-child {{ border-bottom: none; }}
-  .row {{ display: flex; gap: 10px; align-items: flex-start; }}
-  .avatar {{ width: 28px; height: 28px; border-radius: 50%; object-fit: cover; border: 1px solid #eee; }}
-  .content {{ flex: 1; }}
-  .meta {{ font-size: 12px; color: #555; margin-bottom: 4px; }}
-  .body {{ white-space: pre-wrap; word-wrap: break-word; }}
-  .mine .meta {{ color: #245; }}
-  .theirs .meta {{ color: #542; }}
-  .badge {{
-    display:inline-block; padding:0 6px; font-size:11px; border-radius:999px; background:#f1f1f1; color:#333; margin-left:6px;
-  }}
-</style>
-</head>
-<body>
-  <div class="wrap">
-    {''.join(items) if items else '<div style="color:#666">No messages yet. Say hi!</div>'}
-  </div>
-</body>
-</html>
-"""
-    html(messages_html, height=540, scrolling=True)
+    messages_panel(current_convo)
 
     # Composer (optimistic)
     with st.form("composer", clear_on_submit=True):
         # Placeholder reflects DM vs group
-        convs = my_conversations()
-        is_group = any(c["id"] == current_convo and c.get("is_group") for c in convs)
+        is_group = conv_by_id.get(current_convo, {}).get("is_group", False)
         placeholder = "Message group…" if is_group else "Message…"
 
-        text = st.text_area("Message", placeholder=placeholder, height=80, max_chars=2000, key="composer_text")
+        text = st.text_area("Message", placeholder=placeholder, height=80, max_chars=MAX_MESSAGE_CHARS, key="composer_text")
         sent = st.form_submit_button("Send", type="primary")
-        if sent and text.strip():
-            temp = add_optimistic_message(current_convo, me, text.strip())  # show instantly
-            ok = send_message_to_db(current_convo, text)                    # persist
-            mark_optimistic(current_convo, temp["id"], "sent" if ok else "failed")
-            st.cache_data.clear()
+        content = text.strip()
+        if sent and len(content) > MAX_MESSAGE_CHARS:  # don't queue a row the DB would reject
+            st.warning(f"Messages are limited to {MAX_MESSAGE_CHARS} characters ({len(content)} entered).")
+        elif sent and content:
+            temp = add_optimistic_message(current_convo, me, content)  # show instantly
+            send_message_to_db(current_convo, content, temp["id"])     # persist (write-behind)
+            st.rerun()  # the thread above already rendered; redraw it with the new bubble
 
 # ---------- Right: Profile ----------
 with col_right:
@@ -597,20 +1169,21 @@ with col_right:
 
     st.markdown(
         f"{avatar_img(profile.get('avatar_url'), 64)} "
-        f"<span style='font-size:18px;vertical-align:middle;margin-left:8px;'>@{py_html.escape(profile['username'])}</span>",
+        f"<span style='font-size:18px;vertical-align:middle;margin-left:8px;'>@{_esc(profile['username'])}</span>",
         unsafe_allow_html=True,
     )
 
     st.caption("Update your profile photo:")
     up = st.file_uploader("Upload an image", type=["png", "jpg", "jpeg", "webp"], accept_multiple_files=False)
-    if up is not None:
+    # The uploader keeps its file across reruns; only act on a file we haven't stored yet
+    if up is not None and st.session_state.get("_avatar_file_id") != up.file_id:
         data = up.read()
         if len(data) > 0:
             try:
                 url = upload_avatar_to_storage(auth, me, data, up.type or "image/png")
                 auth.table("profiles").update({"avatar_url": url}).eq("id", me).execute()
                 st.success("Avatar updated!")
-                profile["avatar_url"] = url
-                st.cache_data.clear()
+                st.session_state["_avatar_file_id"] = up.file_id
+                profile["avatar_url"] = url  # `people[me]` is seeded from this on the next rerun
             except Exception as e:
                 st.error(f"Upload failed: {e}")
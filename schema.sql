@@ -126,8 +126,10 @@ create table if not exists public.direct_messages (
   conversation_id uuid not null references public.conversations(id) on delete cascade,
   sender_id uuid not null references auth.users(id) on delete cascade,
   content text not null check (length(content) <= 2000),
+  client_id uuid unique,  -- sender-generated idempotency key; retried inserts are ignored
   created_at timestamptz not null default now()
 );
+alter table public.direct_messages add column if not exists client_id uuid unique;
 
 alter table public.direct_messages enable row level security;
 
@@ -152,6 +154,19 @@ for insert with check (
   )
 );
 
+-- Realtime: stream message INSERTs to subscribed clients (delivery still goes through RLS)
+-- (guarded: the dashboard's realtime toggle may already have published the table)
+do $$
+begin
+  if not exists (
+    select 1 from pg_publication_tables
+    where pubname = 'supabase_realtime' and schemaname = 'public' and tablename = 'direct_messages'
+  ) then
+    alter publication supabase_realtime add table public.direct_messages;
+  end if;
+end
+$$;
+
 -- =========
 -- HELPERS
 -- =========
@@ -181,6 +196,23 @@ begin
 end;
 $$;
 
+-- Conversations for a user with their member ids folded in (one round trip)
+create or replace function public.my_conversations_with_members(uid uuid)
+returns setof jsonb
+language sql
+stable
+as $$
+  select to_jsonb(c.*) || jsonb_build_object(
+           'members',
+           coalesce((select jsonb_agg(p.user_id) from public.conversation_participants p
+                     where p.conversation_id = c.id), '[]'::jsonb)
+         )
+  from public.conversations c
+  join public.conversation_participants cp on cp.conversation_id = c.id
+  where cp.user_id = uid
+  order by c.created_at desc;
+$$;
+
 -- Useful indexes
 create index if not exists idx_friends_me_status_req on public.friends(requester_id, status);
 create index if not exists idx_friends_me_status_addr on public.friends(addressee_id, status);